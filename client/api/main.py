@@ -21,22 +21,55 @@ Environment variables required:
   CLIENT_SECRET         = Issued by OAuth server
   REDIRECT_URI          = Callback URL (must match what is registered)
   NOTES_API_URL         = Base URL of Notes API (e.g., http://localhost:5001)
+  DEV                   = Enable debug mode when run via `python main.py` (default false)
 
 Run:
-  python oauth_client_backend.py
+  DEV=true python oauth_client_backend.py  (Werkzeug dev server with debugger/reloader)
+
+Production:
+  gunicorn -k gevent -w 1 --worker-connections 1000 main:app
+  gevent workers make token exchange / Notes API calls yield instead of
+  blocking the worker while they wait on the network.
+  Run exactly one worker process: user sessions (_SESSIONS) live in process
+  memory, so a request landing on another worker would not be authenticated.
+  Scale with --worker-connections instead.
 
 Dependencies:
-  pip install Flask requests
+  pip install Flask flask_cors requests orjson gunicorn gevent
 """
 
-from flask import Flask, request, redirect, jsonify, session
+from flask import Flask, Response, request, redirect, jsonify
 from flask_cors import CORS, cross_origin
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode, quote
+from collections import OrderedDict
 import os
+import secrets
+import threading
+import time
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and request.get_json)."""
+
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # e.g. nesting deeper than orjson's 254-level limit; stdlib json copes
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
-app.secret_key = "dev-secret"  # For demo only
 
 # Configuration
 OAUTH_AUTH_URL = os.getenv("OAUTH_AUTH_URL", "")
@@ -45,11 +78,56 @@ CLIENT_ID = os.getenv("CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "")
 NOTES_API_URL = os.getenv("NOTES_API_URL", "")
+DEV = os.getenv("DEV", "false").lower() in ("1", "true", "yes")
 
 REQUESTED_SCOPES = "notes:read notes:write"
 
-# Simple in-memory token storage per session
+# Shared HTTP session so calls to the OAuth server / Notes API reuse pooled connections
+HTTP_TIMEOUT = (2, 5)
+HTTP = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,  # hand back the last response instead of raising RetryError
+    ),
+)
+HTTP.mount("http://", _adapter)
+HTTP.mount("https://", _adapter)
+
+# Simple in-memory token storage per session, keyed by the random "sid" cookie:
+# sid -> (monotonic expiry, session dict), in creation (= expiry) order.
+# Sessions only exist in the process that created them, so run a single worker.
 # In real systems, use a DB or encrypted store
+SESSION_COOKIE = "sid"
+SESSION_TTL = 8 * 3600
+SESSION_MAX = 10000
+_SESSIONS = OrderedDict()
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _create_session(data):
+    """Store a new session and return its id, dropping expired / oldest sessions."""
+    sid = secrets.token_urlsafe(16)
+    now = time.monotonic()
+    with _SESSIONS_LOCK:
+        while _SESSIONS and (
+            len(_SESSIONS) >= SESSION_MAX or next(iter(_SESSIONS.values()))[0] <= now
+        ):
+            _SESSIONS.popitem(last=False)
+        _SESSIONS[sid] = (now + SESSION_TTL, data)
+    return sid
+
+
+def _current_session():
+    """Return the stored session for the request's sid cookie, or an empty dict."""
+    entry = _SESSIONS.get(request.cookies.get(SESSION_COOKIE))
+    if entry is None or entry[0] <= time.monotonic():
+        return {}
+    return entry[1]
 
 @app.route("/oauth/login")
 def oauth_login():
@@ -65,7 +143,7 @@ def oauth_login():
     }
 
     # Build redirect URL
-    query = "&".join(f"{k}={requests.utils.quote(v)}" for k, v in params.items())
+    query = urlencode(params, quote_via=quote)
     return redirect(f"{OAUTH_AUTH_URL}?{query}")
 
 
@@ -98,40 +176,54 @@ def oauth_callback():
         "auth": auth
     }
 
-    token_resp = requests.post(OAUTH_TOKEN_URL, json=data, headers={"Content-type": "application/json"})
+    token_resp = HTTP.post(OAUTH_TOKEN_URL, json=data, headers={"Content-type": "application/json"}, timeout=HTTP_TIMEOUT)
 
     if token_resp.status_code != 200:
         return jsonify({"error": "token_exchange_failed", "details": token_resp.text}), 400
 
-    token_data = token_resp.json()
+    token_data = orjson.loads(token_resp.content)
 
-    # Store tokens in session
-    session["access_token"] = token_data.get("access_token")
-    session["refresh_token"] = token_data.get("refresh_token")
-    session["scope"] = token_data.get("scope")
+    # Store tokens server-side; the browser only gets an opaque session id
+    sid = _create_session({
+        "access_token": token_data.get("access_token"),
+        "refresh_token": token_data.get("refresh_token"),
+        "scope": token_data.get("scope"),
+    })
 
-    return jsonify({"message": "Authorization success", "token": token_data})
+    response = jsonify({"message": "Authorization success", "token": token_data})
+    response.set_cookie(
+        SESSION_COOKIE, sid, max_age=SESSION_TTL, httponly=True, secure=True, samesite="Lax"
+    )
+    return response
 
 
 @app.route("/client/notes", methods=["GET"])
 def client_list_notes():
     """
     Called by the client's frontend.
-    Uses stored access_token to call the protected Notes API.
+    Uses stored access_token to call the protected Notes API and streams its
+    response (status, body) back unchanged.
     """
-    access_token = session.get("access_token")
+    access_token = _current_session().get("access_token")
     if not access_token:
         return jsonify({"error": "not_authenticated"}), 401
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    resp = requests.get(f"{NOTES_API_URL}/notes", headers=headers)
+    resp = HTTP.get(f"{NOTES_API_URL}/notes", headers=headers, timeout=HTTP_TIMEOUT, stream=True)
 
-    return jsonify({"status": resp.status_code, "data": resp.json()})
+    response = Response(
+        resp.iter_content(chunk_size=8192),
+        status=resp.status_code,
+        content_type=resp.headers.get("Content-Type", "application/json"),
+    )
+    # Return the pooled connection even if the frontend disconnects mid-stream
+    response.call_on_close(resp.close)
+    return response
 
 
 @app.route("/client/create-note", methods=["POST"])
 def client_create_note():
-    access_token = session.get("access_token")
+    access_token = _current_session().get("access_token")
     if not access_token:
         return jsonify({"error": "not_authenticated"}), 401
 
@@ -141,13 +233,14 @@ def client_create_note():
         "Content-Type": "application/json",
     }
 
-    resp = requests.post(f"{NOTES_API_URL}/notes", json=data, headers=headers)
+    resp = HTTP.post(f"{NOTES_API_URL}/notes", json=data, headers=headers, timeout=HTTP_TIMEOUT)
 
-    return jsonify({"status": resp.status_code, "data": resp.json()})
+    return jsonify({"status": resp.status_code, "data": orjson.loads(resp.content)})
 
 
 @app.route("/session/info")
 def session_info():
+    session = _current_session()
     return jsonify({
         "access_token": session.get("access_token"),
         "refresh_token": session.get("refresh_token"),
@@ -164,4 +257,4 @@ if __name__ == "__main__":
     print("Starting OAuth Client Backend API on port 5002...")
     print("AUTH_URL=", OAUTH_AUTH_URL)
     print("TOKEN_URL=", OAUTH_TOKEN_URL)
-    app.run(host="0.0.0.0", port=5002, debug=True)
+    app.run(host="0.0.0.0", port=5002, debug=DEV)
@@ -12,54 +12,138 @@ Features:
   3. JWKS: validate JWT using JWKS public keys (optional)
 
 Usage (quick):
-  - python protected_notes_api.py
+  - DEV=true python protected_notes_api.py  (Werkzeug dev server with debugger/reloader)
   - By default it runs in TEST_MODE and accepts token 'test-token'.
 
+Production:
+  - gunicorn -k gevent -w 1 --worker-connections 1000 main:app
+  - gevent workers make outbound introspection / JWKS calls yield instead of
+    blocking the worker while they wait on the network.
+  - Run exactly one worker process: notes (NOTES, NOTES_BY_OWNER, NOTES_JSON)
+    and the token cache live in process memory, so separate workers would each
+    see a different set of notes. Scale with --worker-connections instead.
+
 Environment variables (optional):
   - TEST_MODE (default 'true')
+  - DEV (default 'false'): enable debug mode when run via `python main.py`
   - INTROSPECTION_URL: if set, used to validate opaque tokens
   - INTROSPECTION_CLIENT_ID, INTROSPECTION_CLIENT_SECRET: for basic auth to introspection
   - JWKS_URL: if set, used to validate JWTs (PyJWT + requests)
+  - REVOCATION_LIST_URL: if set, a revocation bitmap polled in the background and
+    checked for JWT-validated tokens (see _poll_revocation_list)
+  - REVOCATION_LIST_INTERVAL: seconds between revocation list refreshes (default 30)
 
 Dependencies:
-  pip install Flask requests PyJWT cryptography
+  pip install Flask requests PyJWT cryptography orjson gunicorn gevent
 
 This is intentionally minimal and easy to hook to your OAuth server later.
 """
 
-from flask import Flask, request, jsonify, abort
-from functools import wraps
+from flask import Flask, Response, request, jsonify, abort, g
+from flask.json.provider import DefaultJSONProvider
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from itertools import count
+import hashlib
 import os
+import threading
 import time
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import jwt
 from jwt import PyJWKClient
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and request.get_json)."""
+
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # e.g. nesting deeper than orjson's 254-level limit; stdlib json copes
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # In-memory "database"
 NOTES = {}
-NEXT_ID = 1
+NOTES_BY_OWNER = defaultdict(set)  # owner -> ids of their notes
+NOTES_JSON = {}  # id -> note serialized once at creation (notes are immutable)
+_ID_SEQ = count(1)  # next() on a count is atomic, unlike a global += 1
 
 # Configuration (read from env)
 TEST_MODE = os.getenv('TEST_MODE', 'true').lower() in ('1', 'true', 'yes')
+DEV = os.getenv('DEV', 'false').lower() in ('1', 'true', 'yes')
 INTROSPECTION_URL = os.getenv('INTROSPECTION_URL')
 INTROSPECTION_CLIENT_ID = os.getenv('INTROSPECTION_CLIENT_ID')
 INTROSPECTION_CLIENT_SECRET = os.getenv('INTROSPECTION_CLIENT_SECRET')
 JWKS_URL = os.getenv('JWKS_URL')
+REVOCATION_LIST_URL = os.getenv('REVOCATION_LIST_URL')
+REVOCATION_LIST_INTERVAL = int(os.getenv('REVOCATION_LIST_INTERVAL', '30'))
+
+# Token cache: blake2b(token) -> (monotonic expiry, token info). Holds results of
+# both JWT verification and introspection, so a repeat token skips the RSA verify
+# as well as the AS round-trip. Kept in LRU order so the oldest entries are
+# dropped once the cache is full.
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_MAX = 4096
+_TOKEN_CACHE = OrderedDict()
+_TOKEN_CACHE_LOCK = threading.Lock()
+# In-flight lookups: blake2b(token) -> Future, so concurrent requests carrying
+# the same uncached token share a single validation / introspection call
+_TOKEN_INFLIGHT = {}
+
+# Shared HTTP session so outbound calls reuse pooled keep-alive connections
+HTTP_TIMEOUT = (2, 5)
+HTTP = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,  # hand back the last response instead of raising RetryError
+    ),
+)
+HTTP.mount('http://', _adapter)
+HTTP.mount('https://', _adapter)
+
+# Shared JWKS client and resolved signing keys (kid -> (monotonic fetch time, key)),
+# so the JWKS is not re-downloaded and re-parsed for every request. Both expire
+# after JWKS_CACHE_LIFESPAN so keys dropped from the JWKS stop being trusted.
+JWKS_CACHE_LIFESPAN = 3600
+_JWK_CLIENT = PyJWKClient(JWKS_URL, lifespan=JWKS_CACHE_LIFESPAN) if JWKS_URL else None
+_SIGNING_KEYS = {}
+
+# Latest revocation bitmap (bit i set => token with revocation index i is revoked).
+# Replaced wholesale by the poller thread, so readers never see a partial update.
+_REVOKED = b''
 
 # Helper: create sample note
 def _create_note(owner, title, content):
-    global NEXT_ID
+    nid = next(_ID_SEQ)
     note = {
-        'id': NEXT_ID,
+        'id': nid,
         'owner': owner,
         'title': title,
         'content': content,
         'created_at': int(time.time())
     }
-    NOTES[NEXT_ID] = note
-    NEXT_ID += 1
+    # Serialize first: orjson.dumps may raise (e.g. nesting too deep), and
+    # nothing must be stored for a note that cannot be served
+    blob = orjson.dumps(note)
+    NOTES[nid] = note
+    NOTES_JSON[nid] = blob
+    NOTES_BY_OWNER[owner].add(nid)
     return note
 
 # Seed with a sample note
@@ -67,38 +151,84 @@ _create_note('user:alice', 'Welcome', 'This is your first note')
 
 # Token validation / introspection helpers
 
+def _unverified_claims(token):
+    """Decode a JWT's claims without verifying it. Returns {} for opaque tokens.
+    Only used to fill in fields a minimal introspection response leaves out,
+    after the AS has already confirmed the token is active.
+    """
+    try:
+        return jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return {}
+
+
+def _post_introspection(token, minimal):
+    """POST a token to the introspection endpoint. Returns the parsed JSON or None."""
+    data = {'token': token}
+    if minimal:
+        data['minimal'] = 'true'
+    auth = None
+    if INTROSPECTION_CLIENT_ID and INTROSPECTION_CLIENT_SECRET:
+        auth = (INTROSPECTION_CLIENT_ID, INTROSPECTION_CLIENT_SECRET)
+    resp = HTTP.post(INTROSPECTION_URL, data=data, auth=auth, timeout=HTTP_TIMEOUT)
+    if resp.status_code != 200:
+        app.logger.warning('Introspection endpoint returned %s', resp.status_code)
+        return None
+    return orjson.loads(resp.content)
+
+
 def _introspect_token(token):
     """Call the configured introspection endpoint.
     Expected response: JSON with at least 'active': true/false and optionally 'scope' and 'sub'.
+    Sends 'minimal=true' only for JWTs carrying a 'sub' claim, so servers that
+    support it can skip loading user claims and the subject is taken from the
+    token itself. Opaque tokens go straight to the full request. Tokens that
+    still have no subject are rejected, since notes are owned by 'sub'.
     Returns a dict with token info or None if invalid/unavailable.
     """
     if not INTROSPECTION_URL:
         return None
-    data = {'token': token}
-    auth = None
-    if INTROSPECTION_CLIENT_ID and INTROSPECTION_CLIENT_SECRET:
-        auth = (INTROSPECTION_CLIENT_ID, INTROSPECTION_CLIENT_SECRET)
     try:
-        resp = requests.post(INTROSPECTION_URL, data=data, auth=auth, timeout=5)
-        if resp.status_code != 200:
-            app.logger.warning('Introspection endpoint returned %s', resp.status_code)
+        claims = _unverified_claims(token)
+        info = _post_introspection(token, minimal=bool(claims.get('sub')))
+        if not info or not info.get('active'):
             return None
-        info = resp.json()
-        if not info.get('active'):
+        sub = info.get('sub') or info.get('username') or claims.get('sub')
+        exp = info.get('exp')
+        if exp is None:
+            exp = claims.get('exp')
+        if not sub:
+            app.logger.warning('Introspection response has no subject; rejecting token')
             return None
-        # normalize scopes into a list
-        scope_str = info.get('scope', '')
-        scopes = scope_str.split() if scope_str else []
+        # normalize scopes into a frozenset
+        scopes = frozenset((info.get('scope') or '').split())
         return {
             'active': True,
             'scopes': scopes,
-            'sub': info.get('sub') or info.get('username')
+            'sub': sub,
+            'exp': exp
         }
     except Exception as e:
         app.logger.exception('Error calling introspection: %s', e)
         return None
 
 
+def _signing_key(token):
+    """Resolve the signing key for a JWT, reusing keys seen for its 'kid' within
+    JWKS_CACHE_LIFESPAN.
+    """
+    kid = jwt.get_unverified_header(token).get('kid')
+    if kid is None:
+        return _JWK_CLIENT.get_signing_key_from_jwt(token).key
+    now = time.monotonic()
+    entry = _SIGNING_KEYS.get(kid)
+    if entry is not None and now - entry[0] < JWKS_CACHE_LIFESPAN:
+        return entry[1]
+    key = _JWK_CLIENT.get_signing_key(kid).key
+    _SIGNING_KEYS[kid] = (now, key)
+    return key
+
+
 def _validate_jwt(token):
     """Validate a JWT using a JWKS URL if provided. Returns token claims dict if valid.
     Requires PyJWT and requests.
@@ -106,97 +236,266 @@ def _validate_jwt(token):
     if not JWKS_URL:
         return None
     try:
-        jwk_client = PyJWKClient(JWKS_URL)
-        signing_key = jwk_client.get_signing_key_from_jwt(token)
-        claims = jwt.decode(token, signing_key.key, algorithms=["RS256"], options={"verify_aud": False})
+        claims = jwt.decode(
+            token,
+            _signing_key(token),
+            algorithms=["RS256"],
+            options={"verify_aud": False, "require": ["exp"], "verify_exp": True},
+        )
+        if not claims.get('sub'):
+            app.logger.warning('JWT has no sub claim; rejecting token')
+            return None
         # parse scopes
         scope = claims.get('scope') or claims.get('scp') or ''
-        scopes = scope.split() if isinstance(scope, str) else scope
-        return {
+        scopes = frozenset(scope.split() if isinstance(scope, str) else scope)
+        info = {
             'active': True,
             'scopes': scopes,
-            'sub': claims.get('sub')
+            'sub': claims.get('sub'),
+            'exp': claims.get('exp')
         }
+        if REVOCATION_LIST_URL:
+            index = claims.get('revocationListIndex')
+            if index is not None:
+                # RevocationList2020 encodes the index as a decimal string
+                try:
+                    if isinstance(index, bool):
+                        raise ValueError(index)
+                    index = int(index)
+                    if index < 0:
+                        raise ValueError(index)
+                except (TypeError, ValueError):
+                    app.logger.warning('Malformed revocationListIndex %r; rejecting token', index)
+                    return None
+            info['revocation_index'] = index
+            jti = claims.get('jti')
+            if index is None and jti:
+                info['revocation_hash'] = int.from_bytes(
+                    hashlib.blake2b(str(jti).encode(), digest_size=4).digest(), 'big')
+        return info
     except Exception as e:
         app.logger.warning('JWT validation failed: %s', e)
         return None
 
 
+def _poll_revocation_list():
+    """Background loop refreshing _REVOKED from REVOCATION_LIST_URL.
+    The endpoint returns the raw bitmap bytes; bit i is (byte i >> 3, bit i & 7).
+    On errors the previous bitmap is kept.
+    """
+    global _REVOKED
+    while True:
+        try:
+            resp = HTTP.get(REVOCATION_LIST_URL, timeout=HTTP_TIMEOUT)
+            if resp.status_code == 200:
+                _REVOKED = resp.content
+            else:
+                app.logger.warning('Revocation list endpoint returned %s', resp.status_code)
+        except Exception as e:
+            app.logger.exception('Error fetching revocation list: %s', e)
+        time.sleep(REVOCATION_LIST_INTERVAL)
+
+
+def _is_revoked(info):
+    """Check a JWT's revocation bit in the local bitmap.
+    Tokens carry either an explicit 'revocationListIndex' claim or, failing that,
+    a 'jti' whose blake2b-32 hash modulo the bitmap size gives the index.
+    """
+    bitmap = _REVOKED
+    nbits = len(bitmap) * 8
+    if not nbits:
+        return False
+    i = info.get('revocation_index')
+    if i is None:
+        h = info.get('revocation_hash')
+        if h is None:
+            return False
+        i = h % nbits
+    elif i >= nbits:
+        app.logger.warning('revocationListIndex %s is beyond the revocation list (%s bits)', i, nbits)
+        return False
+    return bool(bitmap[i >> 3] & (1 << (i & 7)))
+
+
+# Start the revocation list poller (one per process/worker)
+if REVOCATION_LIST_URL:
+    threading.Thread(target=_poll_revocation_list, name='revocation-list', daemon=True).start()
+
+
+_TEST_TOKENS = {
+    'test-token': {'active': True, 'scopes': frozenset({'read:notes', 'write:notes'}), 'sub': 'user:alice'},
+    'read-only': {'active': True, 'scopes': frozenset({'read:notes'}), 'sub': 'user:bob'},
+}
+
+
 def _mock_token_info(token):
     """A simple mock for TEST_MODE. Accept token 'test-token' and return scopes.
     - 'test-token' => scopes: read:notes write:notes
     - 'read-only' => scopes: read:notes
     """
-    if token == 'test-token':
-        return {'active': True, 'scopes': ['read:notes', 'write:notes'], 'sub': 'user:alice'}
-    if token == 'read-only':
-        return {'active': True, 'scopes': ['read:notes'], 'sub': 'user:bob'}
-    return None
+    if not TEST_MODE:
+        return None
+    # Hashed lookup: no byte-by-byte comparison against the known tokens
+    return _TEST_TOKENS.get(token)
 
 
-def introspect(token):
-    """Unified token introspection / validation pipeline.
-    Tries, in order: JWT via JWKS, OAuth2 introspection endpoint, TEST_MODE mock.
-    Returns dict with keys: active (True), scopes (list), sub (string) or None.
-    """
+def _cache_key(token):
+    # Hash the token so raw bearer secrets are never kept in the cache
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def _cache_get(key):
+    with _TOKEN_CACHE_LOCK:
+        entry = _TOKEN_CACHE.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if time.monotonic() >= expires_at:
+            del _TOKEN_CACHE[key]
+            return None
+        _TOKEN_CACHE.move_to_end(key)
+        return info
+
+
+def _cache_put(key, info):
+    """Cache token info until the token expires, capped at TOKEN_CACHE_TTL."""
+    ttl = TOKEN_CACHE_TTL
+    exp = info.get('exp')
+    if isinstance(exp, (int, float)):
+        ttl = min(ttl, exp - time.time())
+    if ttl <= 0:
+        return
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[key] = (time.monotonic() + ttl, info)
+        _TOKEN_CACHE.move_to_end(key)
+        while len(_TOKEN_CACHE) > TOKEN_CACHE_MAX:
+            _TOKEN_CACHE.popitem(last=False)
+
+
+def _resolve_token(token, key):
+    """Validate a token via JWKS, then the introspection endpoint, caching a success."""
     # Try JWT validation first (if JWKS_URL set)
     if JWKS_URL:
         info = _validate_jwt(token)
         if info:
+            _cache_put(key, info)
             return info
     # Try introspection endpoint
     if INTROSPECTION_URL:
         info = _introspect_token(token)
         if info:
+            _cache_put(key, info)
+            return info
+    return None
+
+
+def _resolve_token_once(token, key):
+    """Single-flight wrapper around _resolve_token.
+    The first caller for a token does the work; callers arriving while it is in
+    flight wait on the same Future instead of issuing their own AS request.
+    """
+    with _TOKEN_CACHE_LOCK:
+        future = _TOKEN_INFLIGHT.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _TOKEN_INFLIGHT[key] = future
+    if not leader:
+        return future.result()
+    try:
+        # A previous leader may have filled the cache since our lookup
+        info = _cache_get(key) or _resolve_token(token, key)
+        future.set_result(info)
+        return info
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _TOKEN_CACHE_LOCK:
+            del _TOKEN_INFLIGHT[key]
+
+
+def introspect(token):
+    """Unified token introspection / validation pipeline.
+    Tries, in order: cached result, JWT via JWKS, OAuth2 introspection endpoint, TEST_MODE mock.
+    Successful JWT / introspection results are cached until the token expires
+    (at most TOKEN_CACHE_TTL seconds), and concurrent lookups of the same
+    token are collapsed into one. Cached or not, JWTs are checked against the
+    revocation bitmap when REVOCATION_LIST_URL is set.
+    Returns dict with keys: active (True), scopes (frozenset), sub (string) or None.
+    """
+    if JWKS_URL or INTROSPECTION_URL:
+        key = _cache_key(token)
+        info = _cache_get(key) or _resolve_token_once(token, key)
+        if info:
+            if REVOCATION_LIST_URL and _is_revoked(info):
+                return None
             return info
     # Fallback to test mock
     if TEST_MODE:
         return _mock_token_info(token)
     return None
 
-# Auth decorator
+# Auth
 
 def requires_auth(required_scopes=None):
-    required_scopes = required_scopes or []
+    """Mark a view as protected. The scopes are stored on the view function and
+    enforced by _authenticate before the view runs; the view itself is not wrapped.
+    """
+    required = frozenset(required_scopes or ())
     def decorator(f):
-        @wraps(f)
-        def wrapped(*args, **kwargs):
-            auth = request.headers.get('Authorization', '')
-            if not auth.startswith('Bearer '):
-                return jsonify({'error': 'missing_authorization'}), 401
-            token = auth.split(' ', 1)[1].strip()
-            info = introspect(token)
-            if not info or not info.get('active'):
-                return jsonify({'error': 'invalid_token'}), 401
-            token_scopes = info.get('scopes', [])
-            # Check required scopes
-            missing = [s for s in required_scopes if s not in token_scopes]
-            if missing:
-                return jsonify({'error': 'insufficient_scope', 'missing': missing}), 403
-            # attach token info to request context (simple)
-            request.token_info = info
-            return f(*args, **kwargs)
-        return wrapped
+        f.required_scopes = required
+        return f
     return decorator
 
+
+@app.before_request
+def _authenticate():
+    """Validate the bearer token for views marked with requires_auth.
+    On success the token info is available to the view as g.auth.
+    """
+    # Flask answers OPTIONS itself; it never reaches the protected view
+    if request.method == 'OPTIONS':
+        return None
+    view = app.view_functions.get(request.endpoint)
+    required = getattr(view, 'required_scopes', None)
+    if required is None:
+        return None
+    auth = request.environ.get('HTTP_AUTHORIZATION', '')
+    if auth[:7] != 'Bearer ':
+        return jsonify({'error': 'missing_authorization'}), 401
+    token = auth[7:].strip()
+    info = introspect(token)
+    if not info or not info.get('active'):
+        return jsonify({'error': 'invalid_token'}), 401
+    # Check required scopes
+    missing = required - info.get('scopes', frozenset())
+    if missing:
+        return jsonify({'error': 'insufficient_scope', 'missing': sorted(missing)}), 403
+    g.auth = info
+    return None
+
 # Routes
 
 @app.route('/notes', methods=['GET'])
 @requires_auth(required_scopes=['read:notes'])
 def list_notes():
     """List notes belonging to the token subject (sub)."""
-    sub = request.token_info.get('sub')
-    user_notes = [n for n in NOTES.values() if n['owner'] == sub]
-    return jsonify(user_notes)
+    sub = g.auth.get('sub')
+    # Notes deleted after the id snapshot is taken are skipped, not raised on
+    blobs = (NOTES_JSON.get(i) for i in sorted(NOTES_BY_OWNER.get(sub, ())))
+    body = b'[' + b','.join(b for b in blobs if b is not None) + b']'
+    return Response(body, mimetype='application/json')
 
 @app.route('/notes/<int:note_id>', methods=['GET'])
 @requires_auth(required_scopes=['read:notes'])
 def get_note(note_id):
-    sub = request.token_info.get('sub')
+    sub = g.auth.get('sub')
     note = NOTES.get(note_id)
-    if not note or note['owner'] != sub:
+    blob = NOTES_JSON.get(note_id)
+    if not note or blob is None or note['owner'] != sub:
         return jsonify({'error': 'not_found'}), 404
-    return jsonify(note)
+    return Response(blob, mimetype='application/json')
 
 @app.route('/notes', methods=['POST'])
 @requires_auth(required_scopes=['write:notes'])
@@ -206,18 +505,23 @@ def create_note():
     content = data.get('content', '')
     if not title:
         return jsonify({'error': 'title_required'}), 400
-    sub = request.token_info.get('sub')
-    note = _create_note(sub, title, content)
+    sub = g.auth.get('sub')
+    try:
+        note = _create_note(sub, title, content)
+    except TypeError:  # includes orjson.JSONEncodeError
+        return jsonify({'error': 'invalid_content'}), 400
     return jsonify(note), 201
 
 @app.route('/notes/<int:note_id>', methods=['DELETE'])
 @requires_auth(required_scopes=['write:notes'])
 def delete_note(note_id):
-    sub = request.token_info.get('sub')
+    sub = g.auth.get('sub')
     note = NOTES.get(note_id)
     if not note or note['owner'] != sub:
         return jsonify({'error': 'not_found'}), 404
-    del NOTES[note_id]
+    NOTES_BY_OWNER[sub].discard(note_id)
+    NOTES.pop(note_id, None)
+    NOTES_JSON.pop(note_id, None)
     return '', 204
 
 @app.route('/.well-known/health', methods=['GET'])
@@ -228,8 +532,9 @@ if __name__ == '__main__':
     # helpful startup info printed to console
     print('Starting Protected Notes API (Flask)')
     print('TEST_MODE=', TEST_MODE)
+    print('DEV=', DEV)
     if INTROSPECTION_URL:
         print('INTROSPECTION_URL=', INTROSPECTION_URL)
     if JWKS_URL:
         print('JWKS_URL=', JWKS_URL)
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    app.run(host='0.0.0.0', port=5001, debug=DEV)